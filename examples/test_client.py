@@ -22,14 +22,16 @@
 
 """Example SSB Client"""
 
-from asyncio import ensure_future, gather, get_event_loop
+from asyncio import FIRST_COMPLETED, Future, ensure_future, gather, get_event_loop, wait
 import base64
+from contextlib import asynccontextmanager
 import hashlib
 import logging
+import os
 import struct
 import time
+from typing import AsyncIterator, Optional, Tuple
 
-from colorlog import ColoredFormatter
 from nacl.signing import SigningKey
 from secret_handshake.network import SHSClient
 
@@ -38,6 +40,11 @@ from ssb.packet_stream import PacketStream, PSMessageType
 from ssb.util import load_ssb_secret
 
 api = MuxRPCAPI()
+# This is what struct.pack("l") produced on 64-bit Linux, but without depending on the platform
+_pack_timestamp = struct.Struct("<q").pack
+# The API replies through a single connection, so there is at most one open at a time: the identity it belongs to, the
+# packet stream and the task processing its messages
+_connection: Optional[Tuple[bytes, PacketStream, "Future[None]"]] = None
 
 
 @api.define("createHistoryStream")
@@ -56,9 +63,7 @@ def create_wants(connection: PacketStream, msg: MuxRPCRequest) -> None:  # pylin
     print("create_wants", msg)
 
 
-async def test_client() -> None:
-    """The actual client implementation"""
-
+async def _history() -> None:
     async for msg in api.call(
         "createHistoryStream",
         [
@@ -73,6 +78,8 @@ async def test_client() -> None:
     ):
         print("> RESPONSE:", msg)
 
+
+async def _whoami() -> None:
     try:
         response_handler = api.call("whoami", [], "sync")
         response = await response_handler.get_response()
@@ -81,41 +88,114 @@ async def test_client() -> None:
     except MuxRPCAPIException as e:
         print(e)
 
+
+async def _ping() -> None:
     handler = api.call("gossip.ping", [], "duplex")
-    handler.send(struct.pack("l", int(time.time() * 1000)), msg_type=PSMessageType.BUFFER)
+    handler.send(_pack_timestamp(time.time_ns() // 1_000_000), msg_type=PSMessageType.BUFFER)
 
     async for msg in handler:
         print("> RESPONSE:", msg)
         handler.send(True, end=True)
         break
 
-    img_data = b""
-    async for msg in api.call("blobs.get", ["&kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM=.sha256"], "source"):
-        assert msg
 
-        if msg.type.name == "BUFFER":
-            img_data += msg.data
+async def _fetch_blob() -> None:
+    # Hash and store the blob as it comes in, but only move it to its final place once the hash has been verified
+    img_hash = hashlib.sha256()
+
+    with open("./ub1k.jpg.part", "wb") as f:
+        async for msg in api.call("blobs.get", ["&kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM=.sha256"], "source"):
+            assert msg
+
+            if msg.type.name == "BUFFER":
+                img_hash.update(msg.data)
+                f.write(msg.data)
+
+    assert base64.b64encode(img_hash.digest()) == b"kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM="
+    os.replace("./ub1k.jpg.part", "./ub1k.jpg")
+
+
+async def test_client() -> None:
+    """The actual client implementation"""
+
+    # These calls are independent of each other, and MuxRPC multiplexes them over the same connection
+    await gather(_history(), _whoami(), _ping(), _fetch_blob())
+
+
+def _close_connection() -> None:
+    global _connection  # pylint: disable=global-statement
+
+    if _connection is None:
+        return
+
+    _, packet_stream, processing = _connection
+    _connection = None
+    processing.cancel()
 
-        if msg.type.name == "JSON" and msg.data == b"true":
-            assert (
-                base64.b64encode(hashlib.sha256(img_data).digest()) == b"kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM="
-            )
+    if packet_stream.is_connected:
+        packet_stream.disconnect()
 
-            with open("./ub1k.jpg", "wb") as f:
-                f.write(img_data)
 
+@asynccontextmanager
+async def get_client(keypair: SigningKey) -> AsyncIterator[Tuple[PacketStream, "Future[None]"]]:
+    """Get a connected packet stream and the task processing its messages, re-using the already open connection of this
+    identity if there is one
 
-async def main(keypair: SigningKey) -> None:
+    Opening a connection means going through the secret handshake (several round trips and Curve25519 operations), so
+    repeated client sessions should share a connection instead of opening a new one each time.
+    """
+
+    global _connection  # pylint: disable=global-statement
+
+    key = bytes(keypair.verify_key)
+
+    if _connection is None or _connection[0] != key or not _connection[1].is_connected or _connection[2].done():
+        # Any other connection, including a dropped one of this identity, must be closed and its message processing
+        # stopped
+        _close_connection()
+
+        client = SHSClient("127.0.0.1", 8008, keypair, bytes(keypair.verify_key))
+        packet_stream = PacketStream(client)
+        await client.open()
+        api.add_connection(packet_stream)
+        _connection = (key, packet_stream, ensure_future(api.process_messages()))
+
+    _, packet_stream, processing = _connection
+
+    yield packet_stream, processing
+
+
+async def _run_session(processing: "Future[None]") -> None:
+    session = ensure_future(test_client())
+
+    # The session only gets replies while the messages are processed, so if that fails, waiting for it would hang
+    await wait((session, processing), return_when=FIRST_COMPLETED)
+
+    if not session.done():
+        session.cancel()
+        # Re-raises whatever ended the processing
+        processing.result()
+
+        raise ConnectionError("The connection was closed before the session finished")
+
+    session.result()
+
+
+async def main(keypair: SigningKey, runs: int = 1) -> None:
     """The main function to run"""
 
-    client = SHSClient("127.0.0.1", 8008, keypair, bytes(keypair.verify_key))
-    packet_stream = PacketStream(client)
-    await client.open()
-    api.add_connection(packet_stream)
-    await gather(ensure_future(api.process_messages()), test_client())
+    try:
+        for _ in range(runs):
+            async with get_client(keypair) as (_, processing):
+                await _run_session(processing)
+    finally:
+        _close_connection()
 
 
 if __name__ == "__main__":
+    # colorlog is only needed when running as a script, so don't make importing this module pay for it
+    from colorlog import ColoredFormatter
+
     # create console handler and set level to debug
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
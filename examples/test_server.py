@@ -25,7 +25,6 @@
 from asyncio import get_event_loop
 import logging
 
-from colorlog import ColoredFormatter
 from secret_handshake import SHSServer
 from secret_handshake.network import SHSDuplexStream
 
@@ -57,6 +56,9 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    # Only needed for the console output set up below
+    from colorlog import ColoredFormatter
+
     # create console handler and set level to debug
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
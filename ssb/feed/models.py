@@ -22,19 +22,37 @@
 
 """Feed models"""
 
-from base64 import b64encode
-from collections import OrderedDict, namedtuple
-from datetime import datetime
+from asyncio import get_running_loop
+from binascii import b2a_base64
+from collections import OrderedDict
+from functools import partial
 from hashlib import sha256
-from typing import Any, Dict, Optional
+import json
+from math import isfinite
+import re
+from time import time_ns
+from typing import Any, Dict, Iterable, List, Optional, Union
 
 from nacl.signing import SigningKey, VerifyKey
-from simplejson import dumps, loads
+from orjson import OPT_INDENT_2, OPT_NON_STR_KEYS, dumps, loads
 from typing_extensions import Self
 
 from ssb.util import tag
 
-OrderedMsg = namedtuple("OrderedMsg", ("previous", "author", "sequence", "timestamp", "hash", "content"))
+# The fixed parts of a serialized message, as laid out by ssb-keys
+_MESSAGE_TEMPLATE = (
+    b'{\n  "previous": %b,\n  "author": %b,\n  "sequence": %d,\n  "timestamp": %b,\n'
+    b'  "hash": "sha256",\n  "content": %b'
+)
+_SIGNATURE_TEMPLATE = b',\n  "signature": %b\n}'
+
+# A float in indented JSON output: the only thing on its line, or the value of a key.  Strings can't contain a raw
+# newline, so nothing inside of them can match
+_FLOAT_TOKEN = re.compile(rb" (-?[0-9]+(?:\.[0-9]+(?:e[+-]?[0-9]+)?|e[+-]?[0-9]+))(?=,?\n)")
+
+# Integers outside of the 64-bit range have at least 19 digits.  orjson silently turns them into floats, so data that
+# may hold one is parsed by the standard library instead
+_LONG_DIGITS = re.compile(rb"[0-9]{19}")
 
 
 class NoPrivateKeyException(Exception):
@@ -44,28 +62,127 @@ class NoPrivateKeyException(Exception):
 def to_ordered(data: Dict[str, Any]) -> OrderedDict[str, Any]:
     """Convert a dictionary to an ``OrderedDict``"""
 
-    smsg = OrderedMsg(**data)
+    return OrderedDict(
+        previous=data["previous"],
+        author=data["author"],
+        sequence=data["sequence"],
+        timestamp=data["timestamp"],
+        hash=data["hash"],
+        content=data["content"],
+    )
+
+
+def _b64str(data: bytes) -> str:
+    """Encode ``data`` as a base64 string"""
+
+    return b2a_base64(data, newline=False).decode("ascii")
+
+
+def _js_float(value: float) -> str:
+    """Format a float like ``JSON.stringify()`` does, which is what ssb-keys signs"""
+
+    if not isfinite(value):
+        return "null"
+
+    if not value:
+        return "0"
+
+    mantissa, _, exponent = repr(abs(value)).partition("e")
+    int_part, _, frac_part = mantissa.partition(".")
+    all_digits = int_part + frac_part
+    digits = all_digits.lstrip("0")
+    # The position of the decimal point relative to the first significant digit
+    point = len(int_part) + int(exponent or 0) - (len(all_digits) - len(digits))
+    digits = digits.rstrip("0")
+    sign = "-" if value < 0 else ""
+
+    if len(digits) <= point <= 21:
+        return sign + digits + "0" * (point - len(digits))
+
+    if 0 < point <= 21:
+        return sign + digits[:point] + "." + digits[point:]
+
+    if -6 < point <= 0:
+        return sign + "0." + "0" * -point + digits
+
+    fraction = "." + digits[1:] if len(digits) > 1 else ""
+
+    return f"{sign}{digits[0]}{fraction}e{point - 1:+d}"
+
+
+def _js_float_token(match: "re.Match[bytes]") -> bytes:
+    return b" " + _js_float(float(match[1])).encode("ascii")
 
-    return OrderedDict((k, getattr(smsg, k)) for k in smsg._fields)
+
+def _dumps_content(content: Any) -> bytes:
+    """Encode message content with an indentation of 2 characters, the same way ``JSON.stringify()`` does"""
+
+    try:
+        data = dumps(content, option=OPT_INDENT_2 | OPT_NON_STR_KEYS)
+    except TypeError:
+        # orjson can't encode integers outside of the 64-bit range, but the standard library produces the same layout
+        data = json.dumps(content, ensure_ascii=False, indent=2).encode("utf-8")
+
+    # Python writes floats differently from JavaScript (for example 1.0 or 1e16), so those are rewritten
+    return _FLOAT_TOKEN.sub(_js_float_token, data)
+
+
+def _loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    """Parse message data, keeping integers outside of the 64-bit range exact"""
+
+    raw = data.encode("utf-8") if isinstance(data, str) else data
+
+    if _LONG_DIGITS.search(raw):
+        return json.loads(bytes(raw))
+
+    return loads(data)
 
 
 def get_millis_1970() -> int:
     """Get the UNIX timestamp in milliseconds"""
 
-    return int(datetime.utcnow().timestamp() * 1000)
+    return time_ns() // 1_000_000
 
 
 class Feed:
     """Base class for feeds"""
 
+    __slots__ = ("_public_key", "_id", "_id_json")
+
     def __init__(self, public_key: VerifyKey):
         self.public_key = public_key
 
+    @property
+    def public_key(self) -> VerifyKey:
+        """The public key of the feed"""
+
+        return self._public_key
+
+    @public_key.setter
+    def public_key(self, key: VerifyKey) -> None:
+        self._public_key = key
+        # The identifier is derived from the key
+        self._id: Optional[str] = None
+        self._id_json: Optional[bytes] = None
+
     @property
     def id(self) -> str:
         """The identifier of the feed"""
 
-        return tag(self.public_key).decode("ascii")
+        if self._id is None:
+            self._id = tag(self.public_key).decode("ascii")
+
+        return self._id
+
+    @property
+    def id_json(self) -> bytes:
+        """The identifier of the feed, encoded as a JSON string"""
+
+        if self._id_json is None:
+            # Feed identifiers only contain base64 characters, an @ and a dot, none of which need escaping
+            self._id_json = b'"' + self.id.encode("ascii") + b'"'
+
+        return self._id_json
 
     def sign(self, msg: bytes) -> bytes:
         """Sign a message"""
@@ -76,8 +193,12 @@ class Feed:
 class LocalFeed(Feed):
     """Class representing a local feed"""
 
+    __slots__ = ("private_key",)
+
     def __init__(self, private_key: SigningKey):  # pylint: disable=super-init-not-called
         self.private_key = private_key
+        self._id = None
+        self._id_json = None
 
     @property
     def public_key(self) -> VerifyKey:
@@ -95,9 +216,22 @@ class LocalFeed(Feed):
         return self.private_key.sign(msg).signature
 
 
-class Message:
+class Message:  # pylint: disable=too-many-instance-attributes
     """Base class for SSB messages"""
 
+    __slots__ = (
+        "feed",
+        "content",
+        "signature",
+        "previous",
+        "_previous_key",
+        "sequence",
+        "timestamp",
+        "_serialized_signed",
+        "_serialized_unsigned",
+        "_hash_cache",
+    )
+
     def __init__(  # pylint: disable=too-many-arguments
         self,
         feed: Feed,
@@ -106,12 +240,18 @@ class Message:
         sequence: int = 1,
         timestamp: Optional[int] = None,
         previous: Optional["Message"] = None,
+        previous_key: Optional[str] = None,
     ):
         self.feed = feed
         self.content = content
         self.signature = signature
         self.previous = previous
+        # Messages decoded from elsewhere only know the key of their previous message
+        self._previous_key = previous_key
         self.timestamp = get_millis_1970() if timestamp is None else timestamp
+        self._serialized_signed: Optional[bytes] = None
+        self._serialized_unsigned: Optional[bytes] = None
+        self._hash_cache: Optional[str] = None
 
         if self.previous:
             self.sequence: int = self.previous.sequence + 1
@@ -125,25 +265,68 @@ class Message:
             raise ValueError("signature can't be None")
 
     @classmethod
-    def parse(cls, data: bytes, feed: Feed) -> Self:
+    def parse(cls, data: Union[bytes, bytearray, memoryview, str], feed: Feed) -> Self:
         """Parse raw message data"""
 
-        obj = loads(data, object_pairs_hook=OrderedDict)
-        msg = cls(feed, obj["content"], timestamp=obj["timestamp"])
+        return cls.from_dict(_loads(data), feed)
 
-        return msg
+    @classmethod
+    def from_dict(cls, obj: Dict[str, Any], feed: Feed) -> Self:
+        """Create a message from already decoded message data"""
+
+        return cls(
+            feed,
+            obj["content"],
+            signature=obj.get("signature"),
+            sequence=obj.get("sequence", 1),
+            timestamp=obj["timestamp"],
+            previous_key=obj.get("previous"),
+        )
 
     def serialize(self, add_signature: bool = True) -> bytes:
-        """Serialize the message"""
+        """Serialize the message
+
+        The result is cached, as messages are considered immutable once created.
+        """
 
-        return dumps(self.to_dict(add_signature=add_signature), indent=2).encode("utf-8")
+        if add_signature:
+            if self._serialized_signed is None:
+                # The signed form only differs from the unsigned one by its trailing signature field, so reuse the
+                # latter if we have it (which is always the case for local messages, as it is what gets signed)
+                if self._serialized_unsigned is None:
+                    fields = self._serialize_fields()
+                else:
+                    fields = self._serialized_unsigned[:-2]
+
+                self._serialized_signed = fields + _SIGNATURE_TEMPLATE % dumps(self.signature)
+
+            return self._serialized_signed
+
+        if self._serialized_unsigned is None:
+            self._serialized_unsigned = self._serialize_fields() + b"\n}"
+
+        return self._serialized_unsigned
+
+    def _serialize_fields(self) -> bytes:
+        # This produces the same output as dumping ``to_dict()`` with an indentation of 2 characters (like ssb-keys
+        # does) up to the content field, but only the content needs to go through the JSON encoder, as the rest of the
+        # structure is fixed
+        return _MESSAGE_TEMPLATE % (
+            dumps(self.previous_key),
+            self.feed.id_json,
+            self.sequence,
+            # Timestamps of messages coming from other implementations are not always integers
+            _js_float(self.timestamp).encode("ascii") if isinstance(self.timestamp, float) else dumps(self.timestamp),
+            # Newlines can only appear between JSON tokens, so this is safe to re-indent
+            _dumps_content(self.content).replace(b"\n", b"\n  "),
+        )
 
     def to_dict(self, add_signature: bool = True) -> OrderedDict[str, Any]:
         """Convert the message to a dictionary"""
 
         obj = to_ordered(
             {
-                "previous": self.previous.key if self.previous else None,
+                "previous": self.previous_key,
                 "author": self.feed.id,
                 "sequence": self.sequence,
                 "timestamp": self.timestamp,
@@ -162,13 +345,20 @@ class Message:
 
         return self.signature == signature
 
+    @property
+    def previous_key(self) -> Optional[str]:
+        """The key of the previous message, if there is one"""
+
+        return self.previous.key if self.previous else self._previous_key
+
     @property
     def hash(self) -> str:
         """The cryptographic hash of the message"""
 
-        hash_ = sha256(self.serialize()).digest()
+        if self._hash_cache is None:
+            self._hash_cache = _b64str(sha256(self.serialize()).digest()) + ".sha256"
 
-        return b64encode(hash_).decode("ascii") + ".sha256"
+        return self._hash_cache
 
     @property
     def key(self) -> str:
@@ -180,6 +370,8 @@ class Message:
 class LocalMessage(Message):
     """Class representing a local message"""
 
+    __slots__ = ()
+
     def __init__(  # pylint: disable=too-many-arguments
         self,
         feed: LocalFeed,
@@ -188,8 +380,50 @@ class LocalMessage(Message):
         sequence: int = 1,
         timestamp: Optional[int] = None,
         previous: Optional["LocalMessage"] = None,
+        previous_key: Optional[str] = None,
     ):
-        super().__init__(feed, content, signature=signature, sequence=sequence, timestamp=timestamp, previous=previous)
+        super().__init__(
+            feed,
+            content,
+            signature=signature,
+            sequence=sequence,
+            timestamp=timestamp,
+            previous=previous,
+            previous_key=previous_key,
+        )
+
+    @classmethod
+    async def create(  # pylint: disable=too-many-arguments
+        cls,
+        feed: LocalFeed,
+        content: Dict[str, Any],
+        sequence: int = 1,
+        timestamp: Optional[int] = None,
+        previous: Optional["LocalMessage"] = None,
+    ) -> Self:
+        """Create and sign a message in an executor, so the event loop is not blocked"""
+
+        return await get_running_loop().run_in_executor(
+            None, partial(cls, feed, content, sequence=sequence, timestamp=timestamp, previous=previous)
+        )
+
+    @classmethod
+    async def create_many(
+        cls, feed: LocalFeed, contents: Iterable[Dict[str, Any]], previous: Optional["LocalMessage"] = None
+    ) -> List[Self]:
+        """Create and sign a chain of messages, with a single executor round trip for all of them"""
+
+        def _create_all() -> List[Self]:
+            messages = []
+            last = previous
+
+            for content in contents:
+                last = cls(feed, content, previous=last)
+                messages.append(last)
+
+            return messages
+
+        return await get_running_loop().run_in_executor(None, _create_all)
 
     def _check_signature(self) -> None:
         if self.signature is None:
@@ -199,4 +433,4 @@ class LocalMessage(Message):
         # ensure ordering of keys and indentation of 2 characters, like ssb-keys
         data = self.serialize(add_signature=False)
 
-        return (b64encode(bytes(self.feed.sign(data))) + b".sig.ed25519").decode("ascii")
+        return _b64str(self.feed.sign(data)) + ".sig.ed25519"
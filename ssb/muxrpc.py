@@ -22,11 +22,13 @@
 
 """MuxRPC"""
 
-from typing import Any, AsyncIterator, Callable, Dict, List, Literal, Optional, Union
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union
 
+import orjson
 from typing_extensions import Self
 
-from .packet_stream import PacketStream, PSMessage, PSMessageType, PSRequestHandler, PSStreamHandler
+from .packet_stream import PacketStream, PSMessage, PSMessageType, PSRequestHandler, PSStreamHandler, json_default
 
 MuxRPCJSON = Dict[str, Any]
 MuxRPCCallType = Literal["async", "duplex", "sink", "source", "sync"]
@@ -34,6 +36,13 @@ MuxRPCRequestHandlerType = Callable[[PacketStream, "MuxRPCRequest"], None]
 MuxRPCRequestParam = Union[bytes, str, MuxRPCJSON]  # pylint: disable=invalid-name
 
 
+@lru_cache(maxsize=128)
+def _request_prefix(name: str, type_: MuxRPCCallType) -> bytes:
+    """Encode the constant part of an RPC request, up to its arguments"""
+
+    return orjson.dumps({"name": name.split("."), "type": type_})[:-1] + b',"args":'
+
+
 class MuxRPCAPIException(Exception):
     """Exception to raise on MuxRPC API errors"""
 
@@ -44,9 +53,13 @@ class MuxRPCHandler:
     def check_message(self, msg: PSMessage) -> None:
         """Check message validity"""
 
+        # Only JSON messages can carry an error
+        if msg.type is not PSMessageType.JSON:
+            return
+
         body = msg.body
 
-        if isinstance(body, dict) and "name" in body and body["name"] == "Error":
+        if type(body) is dict and body.get("name") == "Error":  # pylint: disable=unidiomatic-typecheck
             raise MuxRPCAPIException(body["message"])
 
     def __aiter__(self) -> AsyncIterator[Optional[PSMessage]]:
@@ -75,7 +88,10 @@ class MuxRPCRequestHandler(MuxRPCHandler):  # pylint: disable=abstract-method
     async def get_response(self) -> PSMessage:
         """Get the response data"""
 
-        msg = await self.ps_handler.__anext__()
+        try:
+            msg = await self.ps_handler.__anext__()
+        except StopAsyncIteration:
+            raise MuxRPCAPIException("No response available; it was already read, or the request was stopped") from None
 
         self.check_message(msg)
 
@@ -110,7 +126,7 @@ class MuxRPCSinkHandlerMixin:  # pylint: disable=too-few-public-methods
     def send(self, msg: Any, msg_type: PSMessageType = PSMessageType.JSON, end: bool = False) -> None:
         """Send a message through the stream"""
 
-        self.connection.send(msg, stream=True, msg_type=msg_type, req=self.req, end_err=end)
+        self.connection.send_continuation(msg, self.req, stream=True, msg_type=msg_type, end_err=end)
 
 
 class MuxRPCDuplexHandler(MuxRPCSinkHandlerMixin, MuxRPCSourceHandler):  # pylint: disable=abstract-method
@@ -157,6 +173,8 @@ def _get_appropriate_api_handler(
 class MuxRPCRequest:
     """MuxRPC request"""
 
+    __slots__ = ("name_parts", "_name", "args")
+
     @classmethod
     def from_message(cls, message: PSMessage) -> Self:
         """Initialise a request from a raw packet stream message"""
@@ -165,12 +183,32 @@ class MuxRPCRequest:
 
         assert isinstance(body, dict)
 
-        return cls(".".join(body["name"]), body["args"])
+        return cls(body["name"], body["args"])
 
-    def __init__(self, name: str, args: List[MuxRPCRequestParam]):
-        self.name = name
+    def __init__(self, name: Union[str, Sequence[str]], args: List[MuxRPCRequestParam]):
+        self._name: Optional[str] = None
         self.args = args
 
+        if isinstance(name, str):
+            self.name = name
+        else:
+            # Handlers are looked up by the parts of the name, so the name only has to be joined if someone asks for it
+            self.name_parts = tuple(name)
+
+    @property
+    def name(self) -> str:
+        """The name of the requested method"""
+
+        if self._name is None:
+            self._name = ".".join(self.name_parts)
+
+        return self._name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        self._name = name
+        self.name_parts = tuple(name.split("."))
+
     def __repr__(self) -> str:
         return f"<MuxRPCRequest {self.name} {self.args}>"
 
@@ -178,6 +216,8 @@ class MuxRPCRequest:
 class MuxRPCMessage:
     """MuxRPC message"""
 
+    __slots__ = ("body",)
+
     @classmethod
     def from_message(cls, message: PSMessage) -> Self:
         """Initialise a MuxRPC message from a raw packet stream message"""
@@ -196,6 +236,8 @@ class MuxRPCAPI:
 
     def __init__(self) -> None:
         self.handlers: Dict[str, MuxRPCRequestHandlerType] = {}
+        # The names defined in handlers, by their parts, so incoming requests can be looked up without joining them
+        self._names: Dict[Tuple[str, ...], str] = {}
         self.connection: Optional[PacketStream] = None
 
     async def process_messages(self) -> None:
@@ -209,7 +251,8 @@ class MuxRPCAPI:
 
             body = req_message.body
 
-            if isinstance(body, dict) and body.get("name"):
+            # Most incoming messages are stream payloads rather than requests
+            if type(body) is dict and body.get("name"):  # pylint: disable=unidiomatic-typecheck
                 self.process(self.connection, MuxRPCRequest.from_message(req_message))
 
     def add_connection(self, connection: PacketStream) -> None:
@@ -222,6 +265,7 @@ class MuxRPCAPI:
 
         def _handle(f: MuxRPCRequestHandlerType) -> MuxRPCRequestHandlerType:
             self.handlers[name] = f
+            self._names[tuple(name.split("."))] = name
 
             return f
 
@@ -230,7 +274,8 @@ class MuxRPCAPI:
     def process(self, connection: PacketStream, request: MuxRPCRequest) -> None:
         """Process an incoming request"""
 
-        handler = self.handlers.get(request.name)
+        # Handlers may also have been added to handlers directly, which only the joined name can find
+        handler = self.handlers.get(self._names.get(request.name_parts) or request.name)
 
         if not handler:
             raise MuxRPCAPIException(f"Method {request.name} not found!")
@@ -246,8 +291,9 @@ class MuxRPCAPI:
             raise Exception("not connected")  # pylint: disable=broad-exception-raised
 
         old_counter = self.connection.req_counter
-        ps_handler = self.connection.send(
-            {"name": name.split("."), "args": args, "type": type_},
+        # Only the arguments change between calls of the same method, so the rest of the request is encoded just once
+        ps_handler = self.connection.send_json_data(
+            _request_prefix(name, type_) + orjson.dumps(args, default=json_default) + b"}",
             stream=type_ in {"sink", "source", "duplex"},
         )
 
@@ -22,21 +22,25 @@
 
 """Packet streams"""
 
-from asyncio import Event, Queue
+from asyncio import Event, Future, get_running_loop
+from collections import deque
 from enum import Enum
+import json
 import logging
-from math import ceil
 import struct
-from time import time
-from typing import Any, AsyncIterator, Dict, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple, Union
 
+import orjson
 from secret_handshake.network import SHSDuplexStream
-import simplejson
 from typing_extensions import Self
 
 PSMessageData = Union[bytes, bool, Dict[str, Any], str]
+PSBody = Union[bytes, bytearray, memoryview]
 logger = logging.getLogger("packet_stream")
 
+# flags, body length, request number
+_HEADER = struct.Struct(">BIi")
+
 
 class PSMessageType(Enum):
     """Available message types"""
@@ -46,30 +50,78 @@ class PSMessageType(Enum):
     JSON = 2
 
 
+def json_default(obj: Any) -> str:
+    """Encode values that orjson can't serialize on its own"""
+
+    # simplejson used to encode bytes as UTF-8 strings, and callers still rely on that
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8")
+
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _decode_text(body: PSBody) -> str:
+    """Decode a text message body"""
+
+    return str(body, "utf-8")
+
+
+def _decode_json(body: PSBody) -> Any:
+    """Decode a JSON message body"""
+
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        # orjson rejects NaN, Infinity and numbers out of the float range, which the standard library still accepts
+        return json.loads(bytes(body))
+
+
+# Message types by the value of the two lowest header flag bits
+_PS_TYPES = (PSMessageType.BUFFER, PSMessageType.TEXT, PSMessageType.JSON)
+
+# Body decoders, in the same order as _PS_TYPES.  Text and JSON bodies can be decoded from any buffer; only binary
+# bodies need to be turned into bytes
+_DECODERS: Tuple[Callable[[PSBody], Union[bytes, str, Dict[str, Any]]], ...] = (bytes, _decode_text, _decode_json)
+
+
 class PSStreamHandler:
     """Packet stream handler"""
 
     def __init__(self, req: int):
         self.req = req
-        self.queue: Queue["PSMessage"] = Queue()
+        self._messages: Deque[Optional["PSMessage"]] = deque()
+        self._waiter: Optional["Future[None]"] = None
+
+    def _put(self, msg: Optional["PSMessage"]) -> None:
+        self._messages.append(msg)
+
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
 
     async def process(self, msg: "PSMessage") -> None:
         """Process a pending message"""
 
-        await self.queue.put(msg)
+        self._put(msg)
 
     async def stop(self) -> None:
         """Stop a pending request"""
 
-        # We use the None value internally to signal __anext__ that the stream can be closed.  It is not used otherwise,
-        # hence the typing ignore
-        await self.queue.put(None)  # type: ignore[arg-type]
+        # We use the None value internally to signal __anext__ that the stream can be closed
+        self._put(None)
 
     def __aiter__(self) -> AsyncIterator[Optional["PSMessage"]]:
         return self
 
     async def __anext__(self) -> Optional["PSMessage"]:
-        elem = await self.queue.get()
+        while not self._messages:
+            self._waiter = get_running_loop().create_future()
+
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        elem = self._messages.popleft()
 
         if not elem:
             raise StopAsyncIteration()
@@ -84,6 +136,7 @@ class PSRequestHandler:
         self.req = req
         self.event = Event()
         self._msg: Optional["PSMessage"] = None
+        self._consumed = False
 
     async def process(self, msg: "PSMessage") -> None:
         """Process a message request"""
@@ -101,36 +154,61 @@ class PSRequestHandler:
         return self
 
     async def __anext__(self) -> "PSMessage":
-        # wait until 'process' is called
+        # A request has at most one reply, so there is nothing left after it has been returned
+        if self._consumed:
+            raise StopAsyncIteration()
+
+        # wait until 'process' or 'stop' is called
         await self.event.wait()
 
-        assert self._msg
+        self._consumed = True
+        msg, self._msg = self._msg, None
 
-        return self._msg
+        if msg is None:
+            raise StopAsyncIteration()
+
+        return msg
 
 
 class PSMessage:
     """Packet Stream message"""
 
+    __slots__ = ("stream", "end_err", "type", "body", "req", "flags", "_data")
+
+    _data: Optional[bytes]
+
     @classmethod
-    def from_header_body(cls, flags: int, req: int, body: bytes) -> Self:
+    def from_header_body(cls, flags: int, req: int, body: PSBody) -> Self:
         """Parse a raw message"""
 
-        type_ = PSMessageType(flags & 0x03)
+        type_id = flags & 0x03
 
-        if type_ == PSMessageType.TEXT:
-            decoded_body: Union[str, Dict[str, Any], bytes] = body.decode("utf-8")
-        elif type_ == PSMessageType.JSON:
-            decoded_body = simplejson.loads(body)
-        else:
-            decoded_body = body
+        try:
+            type_ = _PS_TYPES[type_id]
+        except IndexError:
+            raise ValueError(f"{type_id} is not a valid PSMessageType") from None
+
+        return cls(type_, _DECODERS[type_id](body), bool(flags & 0x08), bool(flags & 0x04), req=req)
+
+    @classmethod
+    def from_json_data(cls, data: bytes, stream: bool, end_err: bool, req: Optional[int] = None) -> Self:
+        """Create a JSON message from a body that is already encoded"""
 
-        return cls(type_, decoded_body, bool(flags & 0x08), bool(flags & 0x04), req=req)
+        msg = cls(PSMessageType.JSON, data, stream, end_err, req=req)
+        msg._data = data
+
+        return msg
 
     @property
     def data(self) -> bytes:
         """The raw message data"""
 
+        if self._data is None:
+            self._data = self._encode_body()
+
+        return self._data
+
+    def _encode_body(self) -> bytes:
         if self.body is True:
             return b"true"
 
@@ -141,7 +219,7 @@ class PSMessage:
 
         if self.type == PSMessageType.JSON:
             assert isinstance(self.body, dict)
-            return simplejson.dumps(self.body).encode("utf-8")
+            return orjson.dumps(self.body, default=json_default)
 
         assert isinstance(self.body, bytes)
 
@@ -160,6 +238,9 @@ class PSMessage:
         self.type = type_
         self.body = body
         self.req = req
+        # The flags byte of the packet header
+        self.flags = (0x08 if stream else 0) | (0x04 if end_err else 0) | type_.value
+        self._data = None
 
     def __repr__(self) -> str:
         if self.body is True:
@@ -183,13 +264,15 @@ class PacketStream:
     def __init__(self, connection: SHSDuplexStream):
         self.connection = connection
         self.req_counter = 1
-        self._event_map: Dict[int, Tuple[float, Union[PSRequestHandler, PSStreamHandler]]] = {}
+        self._event_map: Dict[int, Union[PSRequestHandler, PSStreamHandler]] = {}
         self._connected = False
+        self._buffer = bytearray()
+        self._write_queue: Optional[List[bytes]] = None
 
     def register_handler(self, handler: Union[PSRequestHandler, PSStreamHandler]) -> None:
         """Register an RPC handler"""
 
-        self._event_map[handler.req] = (time(), handler)
+        self._event_map[handler.req] = handler
 
     @property
     def is_connected(self) -> bool:
@@ -212,34 +295,71 @@ class PacketStream:
 
                 return msg
 
-    async def _read(self) -> Optional[PSMessage]:
+    async def _fill(self, size: int) -> bool:
+        # Packets are not aligned with the chunks the connection returns: a chunk may hold a header together with its
+        # body, or even several packets, so whatever is not consumed stays in the buffer for the next read
+        while len(self._buffer) < size:
+            read_data = await self.connection.read()
+
+            if not read_data:
+                return False
+
+            self._buffer += read_data
+
+        return True
+
+    def _decode(self, flags: int, req: int, length: int) -> PSMessage:
         try:
-            header = await self.connection.read()
+            if flags & 0x03 == PSMessageType.BUFFER.value:
+                # A binary body is turned into bytes straight out of the buffer, so it is copied only once.  The views
+                # have to be released before the buffer can shrink
+                with memoryview(self._buffer) as view, view[:length] as body:
+                    return PSMessage.from_header_body(flags, req, body)
 
-            if not header or header == b"\x00" * 9:
-                return None
+            # Text and JSON decode a lot faster from a bytearray than through a view, which is worth the copy
+            return PSMessage.from_header_body(flags, req, self._buffer[:length])
+        finally:
+            del self._buffer[:length]
 
-            flags, length, req = struct.unpack(">BIi", header)
-            n_packets = ceil(length / 4096)
-            body = b""
+    async def _read(self) -> Optional[PSMessage]:
+        try:
+            while True:
+                if not await self._fill(_HEADER.size):
+                    return None
 
-            for _ in range(n_packets):
-                read_data = await self.connection.read()
+                # The header is parsed in place, it is never needed as an object of its own
+                flags, length, req = _HEADER.unpack_from(self._buffer)
+                del self._buffer[: _HEADER.size]
 
-                if not read_data:
+                # An all-zero header marks the end of the stream
+                if not (flags or length or req):
+                    return None
+
+                if not await self._fill(length):
                     logger.debug("DISCONNECT")
-                    self.connection.disconnect()
+                    self.disconnect()
 
                     return None
 
-                body += read_data
+                logger.debug("READ %s %s %s", flags, req, length)
+
+                try:
+                    return self._decode(flags, req, length)
+                except ValueError as exc:
+                    # Covers both broken JSON and bodies that are not valid UTF-8.  Only this packet is lost, the rest
+                    # of the stream can still be read
+                    logger.warning("DROP [%d]: undecodable body: %s", req, exc)
 
-            logger.debug("READ %s %s", header, len(body))
+                    # Nobody should be left waiting for a reply that could not be read.  A stream may still get more
+                    # packets, so it stays open
+                    handler = self._event_map.get(-req) if req < 0 else None
 
-            return PSMessage.from_header_body(flags, req, body)
+                    if isinstance(handler, PSRequestHandler):
+                        del self._event_map[-req]
+                        await handler.stop()
         except StopAsyncIteration:
             logger.debug("DISCONNECT")
-            self.connection.disconnect()
+            self.disconnect()
             return None
 
     async def read(self) -> Optional[PSMessage]:
@@ -252,7 +372,14 @@ class PacketStream:
 
         # check whether it's a reply and handle accordingly
         if msg.req is not None and msg.req < 0:
-            _, handler = self._event_map[-msg.req]
+            handler = self._event_map.get(-msg.req)
+
+            # A request is forgotten after its reply, so a second or late one has nobody to go to
+            if handler is None:
+                logger.warning("DROP [%d]: no pending request for %r", -msg.req, msg)
+
+                return msg
+
             await handler.process(msg)
             logger.info("RESPONSE [%d]: %r", -msg.req, msg)
 
@@ -260,21 +387,46 @@ class PacketStream:
                 await handler.stop()
                 del self._event_map[-msg.req]
                 logger.info("RESPONSE [%d]: EOS", -msg.req)
+            elif isinstance(handler, PSRequestHandler):
+                # A single reply concludes the request; streams only end with an end/error packet
+                del self._event_map[-msg.req]
 
         return msg
 
     def _write(self, msg: PSMessage) -> None:
         logger.info("SEND [%d]: %r", msg.req, msg)
-        header = struct.pack(
-            ">BIi",
-            (int(msg.stream) << 3) | (int(msg.end_err) << 2) | msg.type.value,
-            len(msg.data),
-            msg.req,
-        )
-        self.connection.write(header)
-        self.connection.write(msg.data)
-        logger.debug("WRITE HDR: %s", header)
-        logger.debug("WRITE DATA: %s", msg.data)
+        data = msg.data
+        header = _HEADER.pack(msg.flags, len(data), msg.req)
+
+        if self._write_queue is None:
+            # Send the first packet right away, but hold back whatever else gets sent during the same iteration of the
+            # event loop, so that a burst of packets goes out with a single write
+            self.connection.write(header + data)
+
+            try:
+                get_running_loop().call_soon(self._flush)
+                self._write_queue = []
+            except RuntimeError:
+                # No event loop to flush from, so don't queue anything
+                pass
+        else:
+            self._write_queue += (header, data)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("WRITE HDR: %s", header)
+            logger.debug("WRITE DATA: %s", data)
+
+    def _flush(self) -> None:
+        queue, self._write_queue = self._write_queue, None
+
+        if not queue:
+            return
+
+        # Called from the event loop, so there is no caller to pass a failed write on to
+        try:
+            self.connection.write(b"".join(queue))
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to write %d queued packets", len(queue) // 2)
 
     def send(  # pylint: disable=too-many-arguments
         self,
@@ -286,31 +438,53 @@ class PacketStream:
     ) -> Union[PSRequestHandler, PSStreamHandler]:
         """Send data through the packet stream"""
 
-        update_counter = False
+        if req is not None:
+            self.send_continuation(data, msg_type=msg_type, stream=stream, end_err=end_err, req=req)
+
+            # No new request is started, so the handler of the ongoing one is returned.  If there is none, a new handler
+            # is returned but not registered, as it won't ever get a reply
+            return self._event_map.get(req) or (PSStreamHandler(req) if stream else PSRequestHandler(req))
+
+        return self._start(PSMessage(msg_type, data, stream=stream, end_err=end_err, req=self.req_counter))
+
+    def send_json_data(self, data: bytes, stream: bool = False) -> Union[PSRequestHandler, PSStreamHandler]:
+        """Start a new request whose JSON body is already encoded"""
+
+        return self._start(PSMessage.from_json_data(data, stream=stream, end_err=False, req=self.req_counter))
 
-        if req is None:
-            update_counter = True
-            req = self.req_counter
+    def _start(self, msg: PSMessage) -> Union[PSRequestHandler, PSStreamHandler]:
+        assert msg.req is not None
 
-        msg = PSMessage(msg_type, data, stream=stream, end_err=end_err, req=req)
+        self.req_counter += 1
 
         # send request
         self._write(msg)
 
-        if stream:
-            handler: Union[PSRequestHandler, PSStreamHandler] = PSStreamHandler(self.req_counter)
+        if msg.stream:
+            handler: Union[PSRequestHandler, PSStreamHandler] = PSStreamHandler(msg.req)
         else:
-            handler = PSRequestHandler(self.req_counter)
+            handler = PSRequestHandler(msg.req)
 
         self.register_handler(handler)
 
-        if update_counter:
-            self.req_counter += 1
-
         return handler
 
+    def send_continuation(  # pylint: disable=too-many-arguments
+        self,
+        data: Union[bytes, str, Dict[str, Any]],
+        req: int,
+        msg_type: PSMessageType = PSMessageType.JSON,
+        stream: bool = False,
+        end_err: bool = False,
+    ) -> None:
+        """Send data within an exchange that is already going on, such as a sink chunk or a reply"""
+
+        self._write(PSMessage(msg_type, data, stream=stream, end_err=end_err, req=req))
+
     def disconnect(self) -> None:
         """Disconnect the stream"""
 
+        # Whatever is still queued goes out first, and the flush scheduled for it becomes a no-op
+        self._flush()
         self._connected = False
         self.connection.disconnect()
@@ -23,12 +23,18 @@
 """Utility functions"""
 
 from base64 import b64decode, b64encode
+from functools import lru_cache
 import os
-from typing import Optional, TypedDict
+from typing import Optional, Tuple, TypedDict
 
 from nacl.signing import SigningKey, VerifyKey
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML was built without libyaml
+    from yaml import SafeLoader  # type: ignore[assignment]
+
 
 class SSBSecret(TypedDict):
     """Dictionary to hold an SSB identity"""
@@ -44,16 +50,15 @@ class ConfigException(Exception):
 def tag(key: VerifyKey) -> bytes:
     """Create tag from public key"""
 
-    return b"@" + b64encode(bytes(key)) + b".ed25519"
+    return b"@%b.ed25519" % b64encode(bytes(key))
 
 
-def load_ssb_secret(filename: Optional[str] = None) -> SSBSecret:
-    """Load SSB keys from ``filename`` or, if unset, from ``~/.ssb/secret``"""
-
-    filename = filename or os.path.expanduser("~/.ssb/secret")
+@lru_cache(maxsize=16)
+def _load_ssb_secret(filename: str, version: Tuple[int, int, int]) -> SSBSecret:  # pylint: disable=unused-argument
+    """Load SSB keys from ``filename``, cached for as long as the file doesn't change"""
 
     with open(filename, encoding="utf-8") as f:
-        config = yaml.load(f, Loader=yaml.SafeLoader)
+        config = yaml.load(f, Loader=SafeLoader)
 
     if config["curve"] != "ed25519":
         raise ConfigException("Algorithm not known: " + config["curve"])
@@ -61,3 +66,15 @@ def load_ssb_secret(filename: Optional[str] = None) -> SSBSecret:
     server_prv_key = b64decode(config["private"][:-8])
 
     return {"keypair": SigningKey(server_prv_key[:32]), "id": config["id"]}
+
+
+def load_ssb_secret(filename: Optional[str] = None) -> SSBSecret:
+    """Load SSB keys from ``filename`` or, if unset, from ``~/.ssb/secret``"""
+
+    filename = filename or os.path.expanduser("~/.ssb/secret")
+
+    # The modification time alone can miss a file rewritten within its resolution, or replaced by another file
+    stat = os.stat(filename)
+
+    # Hand out a copy, so callers can't change what's in the cache
+    return _load_ssb_secret(filename, (stat.st_mtime_ns, stat.st_size, stat.st_ino)).copy()
@@ -24,14 +24,16 @@
 
 from base64 import b64decode
 from collections import OrderedDict
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from nacl.signing import SigningKey, VerifyKey
+import orjson
 import pytest
 from pytest_mock import MockerFixture
 
 from ssb.feed import Feed, LocalFeed, LocalMessage, Message, NoPrivateKeyException
 from ssb.feed.models import get_millis_1970
+from ssb.util import tag
 
 SERIALIZED_M1 = b"""{
   "previous": null,
@@ -49,6 +51,32 @@ SERIALIZED_M1 = b"""{
 }"""
 
 
+# A message as written by JSON.stringify(msg, null, 2), which is what ssb-keys signs.  JavaScript writes numbers in
+# its own way, and only has doubles, so the integers here are those it can represent.  The signature is not checked
+SERIALIZED_NUMBERS = b"""{
+  "previous": null,
+  "author": "@I/4cyN/jPBbDsikbHzAEvmaYlaJK33lW3UhWjNXjyrU=.ed25519",
+  "sequence": 1,
+  "timestamp": 1495706260190.5,
+  "hash": "sha256",
+  "content": {
+    "type": "test",
+    "floats": [
+      10000000000000000,
+      1e+21,
+      1,
+      0.5,
+      1e-7,
+      -2.5e-7,
+      123.456
+    ],
+    "big": 18446744073709552000,
+    "small": -9223372036854776000
+  },
+  "signature": "lPsQ9P10OgeyH6u0unFgiI2wV/RQ7Q2x2ebxnXYCzsJ055TBMXphRADTKhOMS2EkUxXQ9k3amj5fnWPudGxwBQ==.sig.ed25519"
+}"""
+
+
 @pytest.fixture()
 def local_feed() -> LocalFeed:
     """Fixture providing a local feed"""
@@ -86,6 +114,20 @@ def test_local_feed_set_pubkey(local_feed: LocalFeed) -> None:  # pylint: disabl
     assert str(ctx.value) == "Can not set only the public key for a local feed"
 
 
+def test_remote_feed_set_pubkey(remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
+    """Test that changing the public key of a feed changes its identifier"""
+
+    assert remote_feed.id == "@I/4cyN/jPBbDsikbHzAEvmaYlaJK33lW3UhWjNXjyrU=.ed25519"
+    assert remote_feed.id_json == b'"@I/4cyN/jPBbDsikbHzAEvmaYlaJK33lW3UhWjNXjyrU=.ed25519"'
+
+    key = SigningKey.generate().verify_key
+    remote_feed.public_key = key
+
+    assert remote_feed.public_key == key
+    assert remote_feed.id == tag(key).decode("ascii")
+    assert remote_feed.id_json == b'"' + tag(key) + b'"'
+
+
 def test_remote_feed() -> None:
     """Test a remote feed"""
 
@@ -93,6 +135,7 @@ def test_remote_feed() -> None:
     feed = Feed(VerifyKey(public))
     assert bytes(feed.public_key) == public
     assert feed.id == "@I/4cyN/jPBbDsikbHzAEvmaYlaJK33lW3UhWjNXjyrU=.ed25519"
+    assert feed.id_json == b'"@I/4cyN/jPBbDsikbHzAEvmaYlaJK33lW3UhWjNXjyrU=.ed25519"'
 
     m1 = Message(
         feed,
@@ -145,6 +188,27 @@ def test_local_message(local_feed: LocalFeed) -> None:  # pylint: disable=redefi
     assert m2.key == "%nx13uks5GUwuKJC49PfYGMS/1pgGTtwwdWT7kbVaroM=.sha256"
 
 
+@pytest.mark.asyncio
+async def test_local_message_create(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-outer-name
+    """Test creating local messages without blocking the event loop"""
+
+    m1 = await LocalMessage.create(
+        local_feed,
+        OrderedDict([("type", "about"), ("about", local_feed.id), ("name", "neo"), ("description", "The Chosen One")]),
+        timestamp=1495706260190,
+    )
+    assert m1.sequence == 1
+    assert m1.key == "%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256"
+
+    contents = [{"type": "test", "n": 2}, {"type": "test", "n": 3}]
+    m2, m3 = await LocalMessage.create_many(local_feed, contents, previous=m1)
+    assert m2.previous is m1
+    assert m2.sequence == 2
+    assert m3.previous is m2
+    assert m3.sequence == 3
+    assert m3.signature == LocalMessage(local_feed, m3.content, timestamp=m3.timestamp, previous=m2).signature
+
+
 def test_remote_message(remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
     """Test a remote message"""
 
@@ -205,6 +269,64 @@ def test_serialize(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-
     assert m1.serialize() == SERIALIZED_M1
 
 
+def test_serialize_unicode(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-outer-name
+    """Test that non-ASCII content is serialized as UTF-8, like ``JSON.stringify()`` does"""
+
+    msg = LocalMessage(local_feed, OrderedDict([("type", "post"), ("text", "Olá, “mundo”")]), timestamp=1495706260190)
+
+    assert b'"text": "Ol\xc3\xa1, \xe2\x80\x9cmundo\xe2\x80\x9d"' in msg.serialize()
+
+
+def test_serialize_cached(local_feed: LocalFeed, mocker: MockerFixture) -> None:  # pylint: disable=redefined-outer-name
+    """Test that serialization and hashing only happen once per message"""
+
+    m1 = LocalMessage(
+        local_feed,
+        OrderedDict([("type", "about"), ("about", local_feed.id), ("name", "neo"), ("description", "The Chosen One")]),
+        timestamp=1495706260190,
+    )
+    serialized = m1.serialize()
+    mocked_dumps = mocker.patch("ssb.feed.models.dumps")
+
+    assert serialized == SERIALIZED_M1
+    assert m1.serialize() is serialized
+    assert m1.key == "%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256"
+    assert m1.key == "%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256"
+    mocked_dumps.assert_not_called()
+
+
+def test_serialize_numbers(remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
+    """Test that numbers are written the same way JavaScript writes them"""
+
+    msg = Message(
+        remote_feed,
+        {
+            "type": "test",
+            "floats": [1e16, 1e21, 1.0, 0.5, 1e-7, -2.5e-7, 123.456],
+            "big": 18446744073709552000,
+            "small": -9223372036854776000,
+        },
+        signature=orjson.loads(SERIALIZED_NUMBERS)["signature"],
+        timestamp=1495706260190.5,  # type: ignore[arg-type]
+    )
+
+    assert msg.serialize() == SERIALIZED_NUMBERS
+
+
+def test_parse_numbers(remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
+    """Test that parsing keeps integers outside of the 64-bit range exact, and serializes back to the same data"""
+
+    msg = Message.parse(SERIALIZED_NUMBERS, remote_feed)
+
+    assert msg.content["big"] == 18446744073709552000
+    assert isinstance(msg.content["big"], int)
+    assert msg.content["small"] == -9223372036854776000
+    assert isinstance(msg.content["small"], int)
+    assert msg.serialize() == SERIALIZED_NUMBERS
+
+    assert Message.parse(SERIALIZED_NUMBERS.decode("utf-8"), remote_feed).content == msg.content
+
+
 def test_parse(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-outer-name
     """Test feed parsing"""
 
@@ -212,13 +334,53 @@ def test_parse(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-oute
     assert m1.content == {"type": "about", "about": local_feed.id, "name": "neo", "description": "The Chosen One"}
     assert m1.timestamp == 1495706260190
 
+    m2 = LocalMessage.parse(memoryview(SERIALIZED_M1), local_feed)
+    assert m2.content == m1.content
+    assert m2.timestamp == m1.timestamp
+
+
+def test_from_dict(local_feed: LocalFeed) -> None:  # pylint: disable=redefined-outer-name
+    """Test creating a message from already decoded data"""
+
+    m1 = LocalMessage.from_dict({"timestamp": 1495706260190, "content": {"type": "about", "name": "neo"}}, local_feed)
+    assert m1.content == {"type": "about", "name": "neo"}
+    assert m1.timestamp == 1495706260190
+
+
+def test_from_dict_remote(remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
+    """Test creating a message of a remote feed from already decoded data"""
+
+    obj = orjson.loads(SERIALIZED_M1)
+    msg = Message.from_dict(obj, remote_feed)
+
+    assert msg.feed == remote_feed
+    assert msg.content == obj["content"]
+    assert msg.signature == obj["signature"]
+    assert msg.sequence == obj["sequence"]
+    assert msg.timestamp == obj["timestamp"]
+    assert msg.serialize() == SERIALIZED_M1
+
+
+def test_from_dict_previous(local_feed: LocalFeed, remote_feed: Feed) -> None:  # pylint: disable=redefined-outer-name
+    """Test that a message created from decoded data keeps the key of its previous message"""
+
+    m1 = LocalMessage(local_feed, {"type": "about", "name": "neo"}, timestamp=1495706260190)
+    m2 = LocalMessage(local_feed, {"type": "post", "text": "hello"}, timestamp=1495706260191, previous=m1)
+
+    msg = Message.from_dict(orjson.loads(m2.serialize()), remote_feed)
+
+    assert msg.sequence == 2
+    assert msg.previous is None
+    assert msg.previous_key == m1.key
+    assert msg.to_dict() == m2.to_dict()
+    assert msg.serialize() == m2.serialize()
+    assert msg.key == m2.key
+
 
 def test_local_unsigned(local_feed: LocalFeed, mocker: MockerFixture) -> None:  # pylint: disable=redefined-outer-name
     """Test creating an unsigned message on a local feed"""
 
-    mocked_dt = mocker.Mock(spec=datetime)
-    mocked_dt.utcnow = mocker.MagicMock(return_value=datetime(2023, 3, 7, 11, 45, 54, 0, tzinfo=timezone.utc))
-    mocker.patch("ssb.feed.models.datetime", mocked_dt)
+    mocker.patch("ssb.feed.models.time_ns", return_value=1678189554000000000)
 
     msg = LocalMessage(local_feed, OrderedDict({"test": True}))
 
@@ -264,8 +426,7 @@ def test_local_signed(local_feed: LocalFeed) -> None:  # pylint: disable=redefin
 def test_millis(timestamp: datetime, expected: int, mocker: MockerFixture) -> None:
     """Test the get_millis_1970() function"""
 
-    mocked_dt = mocker.Mock(spec=datetime)
-    mocked_dt.utcnow = mocker.MagicMock(return_value=timestamp)
-    mocker.patch("ssb.feed.models.datetime", mocked_dt)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    mocker.patch("ssb.feed.models.time_ns", return_value=(timestamp - epoch) // timedelta(microseconds=1) * 1000)
 
     assert get_millis_1970() == expected
@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2017 PySSB contributors (see AUTHORS for more details)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for MuxRPC"""
+
+from asyncio import sleep
+from typing import List
+
+import pytest
+
+from ssb.muxrpc import (
+    MuxRPCAPI,
+    MuxRPCAPIException,
+    MuxRPCCallType,
+    MuxRPCRequest,
+    MuxRPCRequestHandler,
+    MuxRPCRequestParam,
+    _request_prefix,
+)
+from ssb.packet_stream import PacketStream, PSMessage, PSMessageType, PSRequestHandler
+
+from .test_packet_stream import MockSHSClient
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("warm_cache", [False, True])
+@pytest.mark.parametrize(
+    "name,args,type_,packet",
+    [
+        (
+            "whoami",
+            [],
+            "sync",
+            b'\x02\x00\x00\x00\x2b\x00\x00\x00\x01{"name":["whoami"],"type":"sync","args":[]}',
+        ),
+        (
+            "blobs.has",
+            [b"&abc"],
+            "async",
+            b'\x02\x00\x00\x00\x37\x00\x00\x00\x01{"name":["blobs","has"],"type":"async","args":["&abc"]}',
+        ),
+        (
+            "createHistoryStream",
+            [{"id": "@foo", "seq": 1}],
+            "source",
+            b'\x0a\x00\x00\x00\x4f\x00\x00\x00\x01{"name":["createHistoryStream"],"type":"source","args":[{"id":"@foo",'
+            b'"seq":1}]}',
+        ),
+    ],
+)
+async def test_call_encoding(
+    name: str, args: List[MuxRPCRequestParam], type_: MuxRPCCallType, packet: bytes, warm_cache: bool
+) -> None:
+    """Test the packets sent for RPC calls"""
+
+    _request_prefix.cache_clear()
+
+    if warm_cache:
+        _request_prefix(name, type_)
+
+    client = MockSHSClient()
+    await client.connect()
+
+    api = MuxRPCAPI()
+    api.add_connection(PacketStream(client))
+
+    api.call(name, args, type_)
+    await sleep(0)
+
+    output = client.get_output()
+    assert next(output) == packet
+    assert next(output, None) is None
+    assert _request_prefix.cache_info().currsize == 1  # pylint: disable=no-value-for-parameter
+
+
+@pytest.mark.asyncio
+async def test_get_response_consumed() -> None:
+    """Test that asking for a response that is no longer there raises an API error"""
+
+    ps_handler = PSRequestHandler(1)
+    handler = MuxRPCRequestHandler(ps_handler)
+    reply = PSMessage(PSMessageType.JSON, {"id": "@foo"}, stream=False, end_err=False, req=-1)
+
+    await ps_handler.process(reply)
+
+    assert await handler.get_response() is reply
+
+    with pytest.raises(MuxRPCAPIException):
+        await handler.get_response()
+
+
+@pytest.mark.asyncio
+async def test_get_response_stopped() -> None:
+    """Test that asking for the response of a stopped request raises an API error"""
+
+    ps_handler = PSRequestHandler(1)
+    handler = MuxRPCRequestHandler(ps_handler)
+
+    await ps_handler.stop()
+
+    with pytest.raises(MuxRPCAPIException):
+        await handler.get_response()
+
+
+def test_process() -> None:
+    """Test that incoming requests are dispatched to the handler of their method"""
+
+    api = MuxRPCAPI()
+    connection = PacketStream(MockSHSClient())
+    requests: List[MuxRPCRequest] = []
+
+    @api.define("blobs.has")
+    def blobs_has(conn: PacketStream, request: MuxRPCRequest) -> None:
+        assert conn is connection
+        requests.append(request)
+
+    message = PSMessage(PSMessageType.JSON, {"name": ["blobs", "has"], "args": ["&abc"]}, stream=False, end_err=False)
+    api.process(connection, MuxRPCRequest.from_message(message))
+
+    assert len(requests) == 1
+    assert requests[0].name == "blobs.has"
+    assert requests[0].args == ["&abc"]
+
+    with pytest.raises(MuxRPCAPIException, match="Method blobs.get not found"):
+        api.process(connection, MuxRPCRequest("blobs.get", []))
+
+    # Handlers can still be added, replaced and removed through the handlers dict
+    api.handlers["blobs.get"] = blobs_has
+    api.process(connection, MuxRPCRequest(["blobs", "get"], []))
+    assert len(requests) == 2
+    assert requests[1].name == "blobs.get"
+
+    del api.handlers["blobs.has"]
+
+    with pytest.raises(MuxRPCAPIException, match="Method blobs.has not found"):
+        api.process(connection, MuxRPCRequest.from_message(message))
+
+    request = MuxRPCRequest.from_message(message)
+    request.name = "blobs.get"
+    assert request.name_parts == ("blobs", "get")
+    api.process(connection, request)
+    assert len(requests) == 3
@@ -22,16 +22,18 @@
 
 """Tests for the packet stream"""
 
-from asyncio import Event, ensure_future, gather
+from asyncio import Event, Future, Queue, ensure_future, gather, sleep
 from asyncio.events import AbstractEventLoop
+from collections import deque
 import json
-from typing import Any, AsyncIterator, Awaitable, Callable, Generator, List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Generator, List, Optional
 
+import orjson
 import pytest
 from pytest_mock import MockerFixture
 from secret_handshake.network import SHSDuplexStream
 
-from ssb.packet_stream import PacketStream, PSMessage, PSMessageType
+from ssb.packet_stream import PacketStream, PSMessage, PSMessageType, PSRequestHandler, PSStreamHandler
 
 
 async def _collect_messages(generator: AsyncIterator[Optional[PSMessage]]) -> List[Optional["PSMessage"]]:
@@ -63,14 +65,19 @@ MSG_BODY_2 = (
 )
 
 
+# Decoded once with the standard library, to compare against what the packet stream decodes
+MSG_BODY_1_PARSED = json.loads(MSG_BODY_1)
+MSG_BODY_2_PARSED = json.loads(MSG_BODY_2)
+
+
 class MockSHSSocket(SHSDuplexStream):
     """A mocked SHS socket"""
 
     def __init__(self, *args: Any, **kwargs: Any):  # pylint: disable=unused-argument
         super().__init__()
 
-        self.input: List[bytes] = []
-        self.output: List[bytes] = []
+        self.input: "Queue[Optional[bytes]]" = Queue()
+        self.output: Deque[bytes] = deque()
         self.is_connected: bool = False
         self._on_connect: List[Callable[[], Awaitable[None]]] = []
 
@@ -82,29 +89,34 @@ class MockSHSSocket(SHSDuplexStream):
     async def read(self) -> Optional[bytes]:
         """Read data from the socket"""
 
-        if not self.input:
-            return None
-
-        return self.input.pop(0)
+        return await self.input.get()
 
     def write(self, data: bytes) -> None:
         """Write data to the socket"""
 
         self.output.append(data)
 
+    def disconnect(self) -> None:
+        """Close the connection"""
+
+        self.is_connected = False
+
     def feed(self, input_: List[bytes]) -> None:
         """Feed data into the connection"""
 
-        self.input += input_
+        for chunk in input_:
+            self.input.put_nowait(chunk)
+
+    def feed_eof(self) -> None:
+        """Signal that the connection has been closed"""
+
+        self.input.put_nowait(None)
 
     def get_output(self) -> Generator[bytes, None, None]:
         """Get the output of a call"""
 
-        while True:
-            if not self.output:
-                break
-
-            yield self.output.pop(0)
+        while self.output:
+            yield self.output.popleft()
 
 
 class MockSHSClient(MockSHSSocket):
@@ -119,13 +131,27 @@ class MockSHSClient(MockSHSSocket):
 class MockSHSServer(MockSHSSocket):
     """A mocked SHS server"""
 
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+
+        self._connect_task: Optional["Future[List[Any]]"] = None
+
     def listen(self) -> None:
         """Listen for new connections"""
 
         self.is_connected = True
 
-        for cb in self._on_connect:
-            ensure_future(cb())
+        # Run all callbacks as one batch; their exceptions are collected, and re-raised by wait_for_callbacks()
+        self._connect_task = ensure_future(gather(*(cb() for cb in self._on_connect), return_exceptions=True))
+
+    async def wait_for_callbacks(self) -> None:
+        """Wait for the on_connect callbacks to finish, re-raising the first exception any of them raised"""
+
+        assert self._connect_task
+
+        for result in await self._connect_task:
+            if isinstance(result, BaseException):
+                raise result
 
 
 @pytest.fixture
@@ -153,10 +179,34 @@ async def test_on_connect(ps_server: MockSHSServer) -> None:  # pylint: disable=
 
     ps_server.on_connect(_on_connect)
     ps_server.listen()
-    await called.wait()
+    await ps_server.wait_for_callbacks()
+    assert called.is_set()
     assert ps_server.is_connected
 
 
+@pytest.mark.asyncio
+async def test_on_connect_exception(ps_server: MockSHSServer) -> None:  # pylint: disable=redefined-outer-name
+    """Test that exceptions in on_connect callbacks are not lost"""
+
+    called = Event()
+
+    async def _on_connect() -> None:
+        called.set()
+
+    async def _on_connect_error() -> None:
+        raise RuntimeError("connect failed")
+
+    ps_server.on_connect(_on_connect_error)
+    ps_server.on_connect(_on_connect)
+    ps_server.listen()
+
+    with pytest.raises(RuntimeError, match="connect failed"):
+        await ps_server.wait_for_callbacks()
+
+    # The other callbacks still ran
+    assert called.is_set()
+
+
 @pytest.mark.asyncio
 async def test_message_decoding(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
     """Test message decoding"""
@@ -174,6 +224,7 @@ async def test_message_decoding(ps_client: MockSHSClient) -> None:  # pylint: di
             b'"seq":10,"live":true,"keys":false}],"type":"source"}',
         ]
     )
+    ps_client.feed_eof()
 
     messages = await _collect_messages(ps)
     assert len(messages) == 1
@@ -193,6 +244,145 @@ async def test_message_decoding(ps_client: MockSHSClient) -> None:  # pylint: di
     }
 
 
+@pytest.mark.parametrize("body,parsed", [(MSG_BODY_1, MSG_BODY_1_PARSED), (MSG_BODY_2, MSG_BODY_2_PARSED)])
+def test_message_decoding_json(body: bytes, parsed: Any) -> None:
+    """Test that JSON bodies decode the same as with the standard library"""
+
+    assert PSMessage.from_header_body(0x0A, -1, body).body == parsed
+
+
+def test_message_decoding_memoryview() -> None:
+    """Test decoding message bodies straight from a memoryview"""
+
+    with memoryview(b'foo{"name":["whoami"],"args":[]}') as view:
+        assert PSMessage.from_header_body(0x00, 1, view[:3]).body == b"foo"
+        assert PSMessage.from_header_body(0x01, 1, view[:3]).body == "foo"
+        assert PSMessage.from_header_body(0x02, 1, view[3:]).body == {"name": ["whoami"], "args": []}
+
+
+def test_message_decoding_json_non_finite() -> None:
+    """Test decoding JSON values that orjson rejects"""
+
+    assert PSMessage.from_header_body(0x02, 1, b'{"a":Infinity,"b":-Infinity,"c":1e400}').body == {
+        "a": float("inf"),
+        "b": float("-inf"),
+        "c": float("inf"),
+    }
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_invalid_json(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test that a packet with a broken JSON body is dropped without ending the stream"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+    handler = ps.send({"name": ["whoami"], "args": []})
+    assert isinstance(handler, PSRequestHandler)
+
+    ps_client.feed(
+        [
+            b"\x02\x00\x00\x00\x04\xff\xff\xff\xff{bad",
+            b"\x02\x00\x00\x00\x04\x00\x00\x00\x02{bad",
+            b"\x01\x00\x00\x00\x05\x00\x00\x00\x03hello",
+        ]
+    )
+    ps_client.feed_eof()
+
+    messages = await _collect_messages(ps)
+    assert len(messages) == 1
+    assert messages[0]
+    assert messages[0].req == 3
+    assert messages[0].body == "hello"
+
+    # The request the broken reply belonged to has been ended
+    assert await _collect_messages(handler) == []
+    assert not ps._event_map  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_invalid_stream_body(  # pylint: disable=redefined-outer-name
+    ps_client: MockSHSClient,
+) -> None:
+    """Test that an undecodable packet of a stream is dropped without ending the stream"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+    handler = ps.send({"name": ["createHistoryStream"], "args": [{}], "type": "source"}, stream=True)
+    assert isinstance(handler, PSStreamHandler)
+
+    ps_client.feed(
+        [
+            b"\x0a\x00\x00\x00\x04\xff\xff\xff\xff{bad",
+            b"\x0a\x00\x00\x00\x01\xff\xff\xff\xff\xff",
+            b"\x0a\x00\x00\x00\x02\xff\xff\xff\xff{}",
+            b"\x0e\x00\x00\x00\x04\xff\xff\xff\xfftrue",
+        ]
+    )
+    ps_client.feed_eof()
+
+    assert await _collect_messages(ps) == []
+
+    messages = await _collect_messages(handler)
+    assert len(messages) == 2
+    assert messages[0]
+    assert messages[0].body == {}
+    assert messages[1]
+    assert messages[1].body is True
+    assert not ps._event_map  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_chunked(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test decoding a message whose body arrives in several chunks"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    ps_client.feed([b"\n\x00\x00\x02\xc5\x00\x00\x00\x01", MSG_BODY_1[:300], MSG_BODY_1[300:600], MSG_BODY_1[600:]])
+    ps_client.feed_eof()
+
+    messages = await _collect_messages(ps)
+    assert len(messages) == 1
+    assert messages[0]
+    assert messages[0].req == 1
+    assert messages[0].body == MSG_BODY_1_PARSED
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_coalesced(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test decoding packets that don't arrive aligned with the chunks read from the connection"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    data = (
+        b"\n\x00\x00\x02\xc5\x00\x00\x00\x01"
+        + MSG_BODY_1
+        + b"\n\x00\x00\x023\x00\x00\x00\x02"
+        + MSG_BODY_2
+        + b"\x01\x00\x00\x00\x05\x00\x00\x00\x03hello"
+        + b"\x00\x00\x00\x00\x03\x00\x00\x00\x04\x00\xff\x01"
+    )
+    ps_client.feed([data[:5], data[5:800], data[800:]])
+    ps_client.feed_eof()
+
+    messages = await _collect_messages(ps)
+    assert len(messages) == 4
+    assert messages[0] and messages[1] and messages[2] and messages[3]
+    assert [messages[0].req, messages[1].req, messages[2].req, messages[3].req] == [1, 2, 3, 4]
+    assert messages[0].body == MSG_BODY_1_PARSED
+    assert messages[1].body == MSG_BODY_2_PARSED
+    assert messages[2].type == PSMessageType.TEXT
+    assert messages[2].body == "hello"
+    assert messages[3].type == PSMessageType.BUFFER
+    assert messages[3].body == b"\x00\xff\x01"
+    assert isinstance(messages[3].body, bytes)
+
+
 @pytest.mark.asyncio
 async def test_message_encoding(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
     """Test message encoding"""
@@ -219,21 +409,171 @@ async def test_message_encoding(ps_client: MockSHSClient) -> None:  # pylint: di
         stream=True,
     )
 
-    header, body = list(ps_client.get_output())
+    output = ps_client.get_output()
+    packet = next(output)
+    assert next(output, None) is None
 
-    assert header == b"\x0a\x00\x00\x00\xa6\x00\x00\x00\x01"
-    assert json.loads(body.decode("utf-8")) == {
-        "name": ["createHistoryStream"],
-        "args": [
-            {
-                "id": "@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519",
-                "seq": 1,
-                "live": False,
-                "keys": False,
-            }
-        ],
-        "type": "source",
-    }
+    assert packet[:9] == b"\x0a\x00\x00\x00\x9a\x00\x00\x00\x01"
+    assert packet[9:] == orjson.dumps(
+        {
+            "name": ["createHistoryStream"],
+            "args": [
+                {
+                    "id": "@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519",
+                    "seq": 1,
+                    "live": False,
+                    "keys": False,
+                }
+            ],
+            "type": "source",
+        }
+    )
+
+
+def test_message_data_cached(mocker: MockerFixture) -> None:
+    """Test that the body of a message is only encoded once"""
+
+    msg = PSMessage(PSMessageType.JSON, {"name": ["whoami"], "args": []}, stream=False, end_err=False, req=1)
+    dumps = mocker.patch("ssb.packet_stream.orjson.dumps", return_value=b'{"name":["whoami"],"args":[]}')
+
+    assert msg.data == b'{"name":["whoami"],"args":[]}'
+    assert msg.data is msg.data
+    assert dumps.call_count == 1
+
+
+def test_message_data_bytes() -> None:
+    """Test that bytes in JSON bodies are encoded as strings"""
+
+    msg = PSMessage(PSMessageType.JSON, {"name": ["blobs", "has"], "args": [b"&abc"]}, stream=False, end_err=False)
+
+    assert msg.data == b'{"name":["blobs","has"],"args":["&abc"]}'
+
+    with pytest.raises(TypeError):
+        _ = PSMessage(PSMessageType.JSON, {"args": [object()]}, stream=False, end_err=False).data
+
+
+def test_message_flags() -> None:
+    """Test that the header flags match the message properties"""
+
+    assert not PSMessage(PSMessageType.BUFFER, b"foo", stream=False, end_err=False).flags
+    assert PSMessage(PSMessageType.TEXT, "foo", stream=True, end_err=False).flags == 0x09
+    assert PSMessage(PSMessageType.JSON, True, stream=True, end_err=True).flags == 0x0E
+    assert PSMessage.from_header_body(0x0A, -1, b"{}").flags == 0x0A
+
+
+def test_message_invalid_type() -> None:
+    """Test that an unknown message type is rejected"""
+
+    with pytest.raises(ValueError):
+        PSMessage.from_header_body(0x03, 1, b"foo")
+
+
+def test_message_data_preencoded() -> None:
+    """Test that an already encoded JSON body is sent as is"""
+
+    msg = PSMessage.from_json_data(b'{"name":["whoami"],"args":[]}', stream=False, end_err=False, req=1)
+
+    assert msg.type == PSMessageType.JSON
+    assert msg.data == b'{"name":["whoami"],"args":[]}'
+
+    # Anywhere else, bytes are not a valid JSON body
+    with pytest.raises(AssertionError):
+        _ = PSMessage(PSMessageType.JSON, b"{}", stream=False, end_err=False, req=1).data
+
+
+@pytest.mark.asyncio
+async def test_message_encoding_coalesced(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test that packets sent in a burst are written together"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    ps.send({"name": ["whoami"], "args": []})
+    ps.send_continuation("foo", 1, msg_type=PSMessageType.TEXT)
+    ps.send_continuation(b"bar", 1, msg_type=PSMessageType.BUFFER)
+
+    # Only the first packet goes out immediately
+    output = ps_client.get_output()
+    assert next(output) == b'\x02\x00\x00\x00\x1d\x00\x00\x00\x01{"name":["whoami"],"args":[]}'
+    assert next(output, None) is None
+
+    await sleep(0)
+
+    output = ps_client.get_output()
+    assert next(output) == b"\x01\x00\x00\x00\x03\x00\x00\x00\x01foo\x00\x00\x00\x00\x03\x00\x00\x00\x01bar"
+    assert next(output, None) is None
+
+
+@pytest.mark.asyncio
+async def test_message_encoding_coalesced_eof(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test that queued packets are written before the stream disconnects on EOF"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    ps.send_continuation("foo", 1, msg_type=PSMessageType.TEXT)
+    ps.send_continuation("bar", 1, msg_type=PSMessageType.TEXT)
+
+    # The connection closes in the middle of a packet
+    ps_client.feed([b"\x01\x00\x00\x00\x05\x00\x00\x00\x03hel"])
+    ps_client.feed_eof()
+
+    assert await ps.read() is None
+    assert not ps_client.is_connected
+    assert list(ps_client.get_output()) == [
+        b"\x01\x00\x00\x00\x03\x00\x00\x00\x01foo",
+        b"\x01\x00\x00\x00\x03\x00\x00\x00\x01bar",
+    ]
+
+    # The flush scheduled for the queue has nothing left to write
+    await sleep(0)
+
+    assert not ps_client.output
+
+
+@pytest.mark.asyncio
+async def test_message_encoding_coalesced_error(
+    ps_client: MockSHSClient,  # pylint: disable=redefined-outer-name
+    mocker: MockerFixture,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """Test that a failed write of queued packets is logged"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    ps.send_continuation("foo", 1, msg_type=PSMessageType.TEXT)
+    ps.send_continuation("bar", 1, msg_type=PSMessageType.TEXT)
+
+    mocker.patch.object(ps_client, "write", side_effect=ConnectionResetError())
+    await sleep(0)
+
+    assert "Failed to write 1 queued packets" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_send_existing_request(ps_client: MockSHSClient) -> None:  # pylint: disable=redefined-outer-name
+    """Test that sending within an existing request does not start a new one"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    handler = ps.send({"name": ["blobs", "add"], "args": [], "type": "sink"}, stream=True)
+
+    assert ps.send(b"foo", msg_type=PSMessageType.BUFFER, stream=True, req=1) is handler
+
+    # Without an ongoing request there is a handler for it all the same, but it doesn't get registered
+    unregistered = ps.send(b"bar", msg_type=PSMessageType.BUFFER, stream=True, req=5)
+    assert isinstance(unregistered, PSStreamHandler)
+    assert unregistered.req == 5
+
+    ps.send_continuation(b"baz", 1, msg_type=PSMessageType.BUFFER, stream=True)
+    assert ps.req_counter == 2
+    assert list(ps._event_map) == [1]  # pylint: disable=protected-access
 
 
 @pytest.mark.asyncio
@@ -267,7 +607,7 @@ async def test_message_stream(
 
     assert ps.req_counter == 2
     assert ps.register_handler.call_count == 1  # type: ignore[attr-defined]  # pylint: disable=no-member
-    handler = list(ps._event_map.values())[0][1]  # pylint: disable=protected-access
+    handler = ps._event_map[1]  # pylint: disable=protected-access
     mock_process = mocker.patch.object(handler, "process")
 
     ps_client.feed([b"\n\x00\x00\x02\xc5\xff\xff\xff\xff", MSG_BODY_1])
@@ -278,7 +618,7 @@ async def test_message_stream(
     assert msg
     assert isinstance(msg.body, dict)
     assert msg.req == -1
-    assert msg.body["previous"] == "%KTGP6W8vF80McRAZHYDWuKOD0KlNyKSq6Gb42iuV7Iw=.sha256"
+    assert msg.body == MSG_BODY_1_PARSED
 
     assert ps.req_counter == 2
 
@@ -298,9 +638,10 @@ async def test_message_stream(
         stream=True,
     )
 
+    assert isinstance(stream_handler, PSStreamHandler)
     assert ps.req_counter == 3
     assert ps.register_handler.call_count == 2  # type: ignore[attr-defined]  # pylint: disable=no-member
-    handler = list(ps._event_map.values())[1][1]  # pylint: disable=protected-access
+    handler = ps._event_map[2]  # pylint: disable=protected-access
 
     mock_process = mocker.patch.object(handler, "process", wraps=handler.process)
 
@@ -312,6 +653,7 @@ async def test_message_stream(
             MSG_BODY_2,
         ]
     )
+    ps_client.feed_eof()
 
     # execute both message polling and response handling loops
     collected, handled = await gather(_collect_messages(ps), _collect_messages(stream_handler))
@@ -326,6 +668,74 @@ async def test_message_stream(
         assert msg
         assert msg.req == -2
 
+    assert [msg.body for msg in handled if msg] == [MSG_BODY_1_PARSED, MSG_BODY_2_PARSED]
+
+
+@pytest.mark.asyncio
+async def test_message_stream_non_stream_reply(
+    ps_client: MockSHSClient,  # pylint: disable=redefined-outer-name
+) -> None:
+    """Test that a non-stream packet does not end a stream request"""
+
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+    stream_handler = ps.send({"name": ["createHistoryStream"], "args": [], "type": "source"}, stream=True)
+    assert isinstance(stream_handler, PSStreamHandler)
+
+    ps_client.feed(
+        [
+            b"\x02\x00\x00\x02\xc5\xff\xff\xff\xff",
+            MSG_BODY_1,
+            b"\x0a\x00\x00\x02\x33\xff\xff\xff\xff",
+            MSG_BODY_2,
+            b"\x0e\x00\x00\x00\x04\xff\xff\xff\xfftrue",
+        ]
+    )
+    ps_client.feed_eof()
+
+    collected, handled = await gather(_collect_messages(ps), _collect_messages(stream_handler))
+
+    assert collected == []
+    assert [msg.body for msg in handled if msg] == [MSG_BODY_1_PARSED, MSG_BODY_2_PARSED, True]
+    assert not ps._event_map  # pylint: disable=protected-access
+
+
+@pytest.mark.asyncio
+async def test_stream_handler() -> None:
+    """Test that a stream handler yields messages in order until stopped"""
+
+    handler = PSStreamHandler(1)
+    first = PSMessage(PSMessageType.TEXT, "foo", stream=True, end_err=False, req=-1)
+    second = PSMessage(PSMessageType.TEXT, "bar", stream=True, end_err=False, req=-1)
+
+    await handler.process(first)
+    collector = ensure_future(_collect_messages(handler))
+    await sleep(0)
+
+    await handler.process(second)
+    await handler.stop()
+
+    assert await collector == [first, second]
+
+
+@pytest.mark.asyncio
+async def test_request_handler() -> None:
+    """Test that a request handler yields its reply only once"""
+
+    handler = PSRequestHandler(1)
+    reply = PSMessage(PSMessageType.TEXT, "foo", stream=False, end_err=False, req=-1)
+
+    await handler.process(reply)
+
+    assert await _collect_messages(handler) == [reply]
+    assert await _collect_messages(handler) == []
+
+    handler = PSRequestHandler(2)
+    await handler.stop()
+
+    assert await _collect_messages(handler) == []
+
 
 @pytest.mark.asyncio
 async def test_message_request(
@@ -334,6 +744,7 @@ async def test_message_request(
     """Test message sending"""
 
     ps_server.listen()
+    await ps_server.wait_for_callbacks()
 
     ps = PacketStream(ps_server)
 
@@ -341,13 +752,15 @@ async def test_message_request(
 
     ps.send({"name": ["whoami"], "args": []})
 
-    header, body = list(ps_server.get_output())
-    assert header == b"\x02\x00\x00\x00 \x00\x00\x00\x01"
-    assert json.loads(body.decode("utf-8")) == {"name": ["whoami"], "args": []}
+    output = ps_server.get_output()
+    packet = next(output)
+    assert next(output, None) is None
+    assert packet[:9] == b"\x02\x00\x00\x00\x1d\x00\x00\x00\x01"
+    assert packet[9:] == orjson.dumps({"name": ["whoami"], "args": []})
 
     assert ps.req_counter == 2
     assert ps.register_handler.call_count == 1  # type: ignore[attr-defined]  # pylint: disable=no-member
-    handler = list(ps._event_map.values())[0][1]  # pylint: disable=protected-access
+    handler = ps._event_map[1]  # pylint: disable=protected-access
     mock_process = mocker.patch.object(handler, "process")
 
     ps_server.feed(
@@ -365,3 +778,11 @@ async def test_message_request(
     assert msg.req == -1
     assert msg.body["id"] == "@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519"
     assert ps.req_counter == 2
+    assert not ps._event_map  # pylint: disable=protected-access
+
+    # A second reply to the same request is dropped, and the stream can still be read
+    ps_server.feed([b"\x02\x00\x00\x00\x02\xff\xff\xff\xff{}"])
+    msg = await ps.read()
+    assert msg
+    assert msg.req == -1
+    assert mock_process.await_count == 1
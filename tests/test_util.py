@@ -23,11 +23,14 @@
 """Tests for the utility functions"""
 
 from base64 import b64decode
-from unittest.mock import mock_open, patch
+import os
+from pathlib import Path
+from typing import Iterator
+from unittest.mock import Mock, mock_open, patch
 
 import pytest
 
-from ssb.util import ConfigException, load_ssb_secret
+from ssb.util import ConfigException, _load_ssb_secret, load_ssb_secret
 
 CONFIG_FILE = """
 ## Comments should be supported too
@@ -42,6 +45,22 @@ CONFIG_FILE = """
 CONFIG_FILE_INVALID = CONFIG_FILE.replace("ed25519", "foo")
 
 
+@pytest.fixture(autouse=True)
+def clear_secret_cache() -> None:
+    """Start every test with an empty secret cache"""
+
+    _load_ssb_secret.cache_clear()
+
+
+@pytest.fixture
+def mock_stat() -> Iterator[None]:
+    """Pretend that the secret file exists"""
+
+    with patch("ssb.util.os.stat", return_value=Mock(st_mtime_ns=1, st_size=1, st_ino=1)):
+        yield
+
+
+@pytest.mark.usefixtures("mock_stat")
 def test_load_secret() -> None:
     """Test loading the SSB secret from a file"""
 
@@ -55,9 +74,52 @@ def test_load_secret() -> None:
     assert bytes(secret["keypair"].verify_key) == b64decode("rsYpBIcXsxjQAf0JNes+MHqT2DL+EfopWKAp4rGeEPQ=")
 
 
+@pytest.mark.usefixtures("mock_stat")
 def test_load_exception() -> None:
     """Test configuration loading if there is a problem with the file"""
 
     with pytest.raises(ConfigException):
         with patch("ssb.util.open", mock_open(read_data=CONFIG_FILE_INVALID), create=True):
             load_ssb_secret()
+
+
+def test_load_secret_cached(tmp_path: Path) -> None:
+    """Test that the secret is only read again if the file changes"""
+
+    filename = str(tmp_path / "secret")
+    other_id = "@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519"
+
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(CONFIG_FILE)
+
+    os.utime(filename, ns=(1_000_000_000, 1_000_000_000))
+
+    secret = load_ssb_secret(filename)
+    secret["id"] = "foo"
+
+    assert load_ssb_secret(filename)["id"] == "@rsYpBIcXsxjQAf0JNes+MHqT2DL+EfopWKAp4rGeEPQ=.ed25519"
+
+    # A file replaced by another one is read again, even if the modification time stays the same
+    with open(filename + ".new", "w", encoding="utf-8") as f:
+        f.write(CONFIG_FILE.replace("@rsYpBIcXsxjQAf0JNes+MHqT2DL+EfopWKAp4rGeEPQ=.ed25519", other_id))
+
+    os.utime(filename + ".new", ns=(1_000_000_000, 1_000_000_000))
+    os.replace(filename + ".new", filename)
+
+    assert load_ssb_secret(filename)["id"] == other_id
+
+    # So is a file rewritten in place with a different size
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(CONFIG_FILE + "\n")
+
+    os.utime(filename, ns=(1_000_000_000, 1_000_000_000))
+
+    assert load_ssb_secret(filename)["id"] == "@rsYpBIcXsxjQAf0JNes+MHqT2DL+EfopWKAp4rGeEPQ=.ed25519"
+
+    # And one with a new modification time
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(CONFIG_FILE.replace("@rsYpBIcXsxjQAf0JNes+MHqT2DL+EfopWKAp4rGeEPQ=.ed25519", other_id) + "\n")
+
+    os.utime(filename, ns=(2_000_000_000, 2_000_000_000))
+
+    assert load_ssb_secret(filename)["id"] == other_id